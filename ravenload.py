@@ -0,0 +1,379 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*
+
+"""Load and soak test harness for the recorder stack.
+
+Launches N synthetic RAVEN message generators, each paired with its own real
+RavenRecorder / RavenLogger as main.scan_and_record does for a dongle, writing
+to the PostgreSQL database named in the configuration file. N is ramped up step
+by step while throughput, queue depth, RSS and database latency are sampled.
+Results are written as JSON lines so runs can be compared across releases.
+"""
+
+import bisect
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import main
+import ravenlogger
+
+
+class RavenLoadException(Exception):
+    pass
+
+
+class RavenLoadError(RavenLoadException):
+    pass
+
+
+class LoadCommandLineParser(main.CommandLineParser):
+    def __init__(self):
+        super(LoadCommandLineParser, self).__init__()
+        self.parser.add_option("-o", "--output", dest="output_file", default="ravenload.jsonl", type="string",
+                               metavar="FILE", help=u"Results filename (JSON lines). Defaults to ravenload.jsonl")
+        self.parser.add_option("--start", dest="start", default=1, type="int",
+                               help=u"Number of simulated ravens in the first step. Defaults to 1")
+        self.parser.add_option("--step", dest="step", default=1, type="int",
+                               help=u"Number of simulated ravens added at each step. Defaults to 1")
+        self.parser.add_option("--max", dest="max", default=10, type="int",
+                               help=u"Maximum number of simulated ravens. Defaults to 10")
+        self.parser.add_option("--rate", dest="rate", default=1.0, type="float",
+                               help=u"Messages per second sent by each simulated raven. Defaults to 1.0")
+        self.parser.add_option("--summation-every", dest="summation_every", default=10, type="int",
+                               help=u"Send a summation message every N messages. Defaults to 10")
+        self.parser.add_option("--step-duration", dest="step_duration", default=60.0, type="float",
+                               help=u"Seconds to hold each step. Use hours worth of seconds to soak. Defaults to 60")
+        self.parser.add_option("--interval", dest="interval", default=5.0, type="float",
+                               help=u"Seconds between samples. Defaults to 5")
+        self.parser.add_option("--saturation-growth", dest="saturation_growth", default=1.0, type="float",
+                               help=u"Queue growth in msg/s over a step that marks it saturated. Defaults to 1.0")
+        self.parser.add_option("--saturation-shortfall", dest="saturation_shortfall", default=0.05, type="float",
+                               help=u"Fraction of offered msg/s left unhandled that marks a step saturated. "
+                                    u"Defaults to 0.05")
+        self.parser.add_option("--keep-going", dest="keep_going", default=False, action="store_true",
+                               help=u"Keep ramping after the first saturated step")
+
+
+class SyntheticRaven(multiprocessing.Process):
+    """Puts messages shaped like Raven.read() output on the queue at a fixed rate
+    """
+    def __init__(self, index, q, stop_request, rate, summation_every, sent):
+        multiprocessing.Process.__init__(self)
+        self.q = q
+        self.stop_request = stop_request
+        self.period = 1.0 / rate
+        self.summation_every = summation_every
+        self.sent = sent
+        self.raven_mac_address = self.derive_mac_address(0xd0, index)
+        self.smartmeter_mac_address = self.derive_mac_address(0xe0, index)
+        self.summation = 0
+
+    def derive_mac_address(self, prefix, index):
+        return "00:13:50:{prefix:02x}:{hi:02x}:{lo:02x}".format(prefix=prefix, hi=(index >> 8) & 0xff, lo=index & 0xff)
+
+    def make_msg(self, count):
+        demand = 500 + (count % 100)
+        self.summation += demand
+        msg = {"type"                   : '1' if count % self.summation_every == 0 else '0',
+               "msg_time"               : datetime.datetime.utcnow().replace(microsecond=0),
+               "msg_value"              : self.summation if count % self.summation_every == 0 else demand,
+               "raven_mac_address"      : self.raven_mac_address,
+               "smartmeter_mac_address" : self.smartmeter_mac_address}
+        return msg
+
+    def run(self):
+        count = 1
+        next_time = time.time()
+        while not self.stop_request.is_set():
+            self.q.put(self.make_msg(count))
+            with self.sent.get_lock():
+                self.sent.value += 1
+            count += 1
+            next_time += self.period
+            delay = next_time - time.time()
+            if delay > 0:
+                self.stop_request.wait(delay)
+        # messages nobody will read must not keep this process from exiting
+        self.q.cancel_join_thread()
+        return
+
+
+class LatencyHistogram(object):
+    """Fixed log spaced latency buckets in shared memory, from 0.1 ms to 100 s
+
+    Memory stays constant however long the run. Counts only ever grow, so the
+    harness diffs snapshots to get a window.
+    """
+    BOUNDS = [0.0001 * 10 ** (i / 10.0) for i in range(61)]
+
+    def __init__(self):
+        self.counts = multiprocessing.Array('L', len(self.BOUNDS) + 1)
+
+    def record(self, seconds):
+        bucket = bisect.bisect_left(self.BOUNDS, seconds)
+        with self.counts.get_lock():
+            self.counts[bucket] += 1
+        return
+
+    def snapshot(self):
+        with self.counts.get_lock():
+            return list(self.counts)
+
+    def summary(self, counts):
+        """Percentiles of a window of counts, as bucket upper bounds in ms (overflow reads 100 s)
+        """
+        total = sum(counts)
+        summary = {"count" : total, "p50_ms" : None, "p95_ms" : None, "p99_ms" : None, "max_ms" : None}
+        if total < 1:
+            return summary
+        for (key, pct) in (("p50_ms", 50), ("p95_ms", 95), ("p99_ms", 99), ("max_ms", 100)):
+            rank = max(1, int(math.ceil(pct / 100.0 * total)))
+            seen = 0
+            for (bucket, count) in enumerate(counts):
+                seen += count
+                if seen >= rank:
+                    summary[key] = self.BOUNDS[min(bucket, len(self.BOUNDS) - 1)] * 1000.0
+                    break
+        return summary
+
+
+class MeteredRavenRecorder(ravenlogger.RavenRecorder):
+    """RavenRecorder that times each database handler into shared counters
+
+    Once step_done is set the recorder stops at the next message instead of
+    draining its backlog, and marks its trace done as usual.
+    """
+    def __init__(self, db_config, raven_config, q, step_done, handled, histogram):
+        super(MeteredRavenRecorder, self).__init__(db_config, raven_config, q)
+        self.step_done = step_done
+        self.handled = handled
+        self.histogram = histogram
+        for msg_type in ('0', '1'):
+            self.q_msg_handler[msg_type] = self.metered(self.q_msg_handler[msg_type])
+
+    def metered(self, handler):
+        def timed_handler(q_msg):
+            if self.step_done.is_set():
+                self.is_logging = False
+                return
+            start = time.time()
+            status = handler(q_msg)
+            self.histogram.record(time.time() - start)
+            with self.handled.get_lock():
+                self.handled.value += 1
+            return status
+        return timed_handler
+
+
+def read_rss_kb(pid):
+    """Resident set size of a process in kB, from /proc. None when unavailable.
+    """
+    try:
+        with open("/proc/{pid}/status".format(pid=pid)) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def diff_counts(now, then):
+    return [a - b for (a, b) in zip(now, then)]
+
+
+class LoadRun(object):
+    def __init__(self, db_config, options, results):
+        self.db_config = db_config
+        self.options = options
+        self.results = results
+
+    def write(self, record):
+        self.results.write(json.dumps(record, sort_keys=True) + "\n")
+        self.results.flush()
+        return
+
+    def stop_processes(self, processes):
+        for process in processes:
+            process.join(self.options.interval * 2)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        return
+
+    def run_step(self, n):
+        step_done = multiprocessing.Event()
+        step_done.clear()
+        sent = multiprocessing.Value('L', 0)
+        handled = multiprocessing.Value('L', 0)
+        histogram = LatencyHistogram()
+        queues = [multiprocessing.Queue() for i in range(n)]
+
+        recorders = []
+        try:
+            for q in queues:
+                recorders.append(MeteredRavenRecorder(self.db_config, {}, q, step_done, handled, histogram))
+        except ravenlogger.RavenLoggerError:
+            for recorder in recorders:
+                recorder.raven_logger.db.close()
+            raise RavenLoadError("cannot open recorder database connection {count} of {n}".format(
+                count=len(recorders) + 1, n=n))
+        generators = [SyntheticRaven(i, q, step_done, self.options.rate, self.options.summation_every, sent)
+                      for (i, q) in enumerate(queues)]
+        for recorder in recorders:
+            recorder.start()
+        for generator in generators:
+            generator.start()
+
+        step_start = time.time()
+        start_depth = sum(q.qsize() for q in queues)
+        peak_rss_kb = None
+        last_handled = 0
+        last_counts = histogram.snapshot()
+        start_counts = last_counts
+        failed = False
+        while time.time() - step_start < self.options.step_duration:
+            sample_start = time.time()
+            time.sleep(self.options.interval)
+            now_handled = handled.value
+            now_counts = histogram.snapshot()
+            elapsed = time.time() - sample_start
+            depth = sum(q.qsize() for q in queues)
+            rss = [read_rss_kb(recorder.pid) for recorder in recorders]
+            rss_kb = None if None in rss else sum(rss)
+            peak_rss_kb = rss_kb if peak_rss_kb is None or rss_kb > peak_rss_kb else peak_rss_kb
+            alive = len([recorder for recorder in recorders if recorder.is_alive()])
+            sample = {"record"           : "sample",
+                      "ravens"           : n,
+                      "elapsed_s"        : time.time() - step_start,
+                      "sent"             : sent.value,
+                      "throughput_mps"   : (now_handled - last_handled) / elapsed,
+                      "queue_depth"      : depth,
+                      "recorders_alive"  : alive,
+                      "recorder_rss_kb"  : rss_kb,
+                      "harness_rss_kb"   : read_rss_kb(os.getpid()),
+                      "db_latency"       : histogram.summary(diff_counts(now_counts, last_counts))}
+            self.write(sample)
+            if self.options.verbose:
+                print "{ravens} ravens: {mps:.1f} msg/s, queue depth {depth}, rss {rss} kB".format(
+                    ravens=n, mps=sample["throughput_mps"], depth=depth, rss=rss_kb)
+            last_handled = now_handled
+            last_counts = now_counts
+            if alive < n:
+                print "{dead} of {n} recorders died during the step".format(dead=n - alive, n=n)
+                failed = True
+                break
+        # freeze the step before shutdown so no backlog drain is counted
+        duration = time.time() - step_start
+        step_handled = handled.value
+        step_counts = diff_counts(histogram.snapshot(), start_counts)
+        depth = sum(q.qsize() for q in queues)
+        step_done.set()
+
+        self.stop_processes(generators)
+        for q in queues:
+            q.put({"type" : "stop"})
+            q.cancel_join_thread()
+        self.stop_processes(recorders)
+        # the parent still holds each connection opened in RavenRecorder.__init__
+        for recorder in recorders:
+            recorder.raven_logger.db.close()
+
+        offered_mps = n * self.options.rate
+        throughput_mps = step_handled / duration
+        growth_mps = (depth - start_depth) / duration
+        saturated = not failed and (growth_mps > self.options.saturation_growth or
+                                    throughput_mps < offered_mps * (1.0 - self.options.saturation_shortfall))
+        step = {"record"               : "step",
+                "ravens"               : n,
+                "duration_s"           : duration,
+                "offered_mps"          : offered_mps,
+                "sent"                 : sent.value,
+                "handled"              : step_handled,
+                "throughput_mps"       : throughput_mps,
+                "start_queue_depth"    : start_depth,
+                "final_queue_depth"    : depth,
+                "queue_growth_mps"     : growth_mps,
+                "peak_recorder_rss_kb" : peak_rss_kb,
+                "recorder_exitcodes"   : [recorder.exitcode for recorder in recorders],
+                "failed"               : failed,
+                "saturated"            : saturated,
+                "db_latency"           : histogram.summary(step_counts)}
+        self.write(step)
+        return step
+
+    def run(self):
+        self.write({"record"     : "run",
+                    "module"     : main.MODULE,
+                    "version"    : main.VERSION,
+                    "started"    : datetime.datetime.utcnow().isoformat(),
+                    "parameters" : {"start"                : self.options.start,
+                                    "step"                 : self.options.step,
+                                    "max"                  : self.options.max,
+                                    "rate"                 : self.options.rate,
+                                    "summation_every"      : self.options.summation_every,
+                                    "step_duration"        : self.options.step_duration,
+                                    "interval"             : self.options.interval,
+                                    "saturation_growth"    : self.options.saturation_growth,
+                                    "saturation_shortfall" : self.options.saturation_shortfall}})
+        max_unsaturated = None
+        first_saturated = None
+        error = None
+        try:
+            for n in range(self.options.start, self.options.max + 1, self.options.step):
+                step = self.run_step(n)
+                if step["failed"]:
+                    error = "recorder died with {n} ravens".format(n=n)
+                    break
+                if step["saturated"]:
+                    first_saturated = step if first_saturated is None else first_saturated
+                    if not self.options.keep_going:
+                        break
+                elif first_saturated is None:
+                    max_unsaturated = step
+        except RavenLoadError as err:
+            error = str(err)
+        summary = {"record"                    : "summary",
+                   "max_unsaturated_ravens"    : None if max_unsaturated is None else max_unsaturated["ravens"],
+                   "saturated_ravens"          : None if first_saturated is None else first_saturated["ravens"],
+                   "saturation_throughput_mps" : None if first_saturated is None else first_saturated["throughput_mps"],
+                   "error"                     : error}
+        self.write(summary)
+        return summary
+
+
+def main_load():
+    parser = LoadCommandLineParser()
+    (options, args) = parser.parse_args()
+    if options.version:
+        print "{module} {version}".format(module=main.MODULE, version=main.VERSION)
+    if options.verbose:
+        parser.state_args()
+    if (options.rate <= 0 or options.step < 1 or options.start < 1 or options.summation_every < 1 or
+            options.interval <= 0 or options.step_duration <= 0):
+        print "rate, start, step, summation-every, interval and step-duration must be positive"
+        sys.exit()
+
+    cfg = main.CfgParser(options.configuration_file)
+    db_config = cfg.get_database_config()
+    if len(db_config) < 1:
+        print "no database configuration in config file: {file}".format(file=options.configuration_file)
+        sys.exit()
+
+    with open(options.output_file, "a") as results:
+        summary = LoadRun(db_config, options, results).run()
+    if summary["error"] is not None:
+        print "load run stopped: {error}".format(error=summary["error"])
+        sys.exit()
+    print "max unsaturated ravens: {ravens}, saturation throughput {mps} msg/s with {saturated} ravens".format(
+        ravens=summary["max_unsaturated_ravens"], mps=summary["saturation_throughput_mps"],
+        saturated=summary["saturated_ravens"])
+
+
+if __name__ == '__main__':
+    main_load()
+    sys.exit()